@@ -1,10 +1,19 @@
 import streamlit as st
 import requests
+from requests.adapters import HTTPAdapter
 import json
 
 
 FASTAPI_URL = "http://127.0.0.1:8000/generate"  
-N8N_WEBHOOK_URL = "https://your-n8n-instance.com/webhook/generate-prospect"  
+
+
+@st.cache_resource
+def get_session():
+    # Shared across reruns so repeated clicks reuse the connection to FastAPI.
+    session = requests.Session()
+    session.mount("http://", HTTPAdapter(pool_connections=4, pool_maxsize=8))
+    session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=8))
+    return session
 
 
 st.title("Sendora AI Prompt Generator")
@@ -44,12 +53,14 @@ if st.button("Generate AI Response"):
         payload = {
             "prompt": prompt,
             "email_to": email_to,
-            "metadata": metadata
+            "metadata": metadata,
+            # The server posts the result to n8n after responding (set N8N_WEBHOOK_URL there).
+            "forward_to_n8n": True
         }
 
         with st.spinner("Calling AI server..."):
             try:
-                response = requests.post(FASTAPI_URL, json=payload, timeout=60)
+                response = get_session().post(FASTAPI_URL, json=payload, timeout=60)
                 response.raise_for_status()
                 data = response.json()
                 
@@ -57,17 +68,5 @@ if st.button("Generate AI Response"):
                 st.success("AI Response Generated Successfully!")
                 st.json(data)
 
-                # this will Send to n8n webhook
-                if N8N_WEBHOOK_URL:
-                    try:
-                        n8n_payload = {**metadata, "aiResponse": data.get("raw_response", "")}
-                        n8n_resp = requests.post(N8N_WEBHOOK_URL, json=n8n_payload, timeout=30)
-                        if n8n_resp.status_code == 200:
-                            st.info("Sent AI response to n8n successfully!")
-                        else:
-                            st.warning(f"n8n webhook returned status {n8n_resp.status_code}")
-                    except Exception as e:
-                        st.error(f"Failed to send data to n8n: {e}")
-
             except requests.exceptions.RequestException as e:
                 st.error(f"Error calling AI server: {e}")
@@ -2,12 +2,18 @@ import os
 import asyncio
 import logging
 import json
+import re
 import sqlite3
-from typing import List, Optional
-from datetime import datetime
-from fastapi import FastAPI, HTTPException, Request
+import threading
+import time
+from contextlib import asynccontextmanager
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional
+from fastapi import BackgroundTasks, FastAPI, HTTPException, Request
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
 import httpx
+import orjson
 from dotenv import load_dotenv
 import smtplib
 from email.message import EmailMessage
@@ -29,12 +35,40 @@ SMTP_USER = os.getenv("SMTP_USER")
 SMTP_PASS = os.getenv("SMTP_PASS")
 DEFAULT_WARNING_TO = os.getenv("WARNING_TO_EMAIL")  
 
+N8N_WEBHOOK_URL = os.getenv("N8N_WEBHOOK_URL")
+
 WATCH_KEYS_INDICES = {5, 8, 10}  #
 
 
 REQUEST_TIMEOUT_SECONDS = int(os.getenv("REQUEST_TIMEOUT_SECONDS") or 20)
 MAX_TOTAL_RETRIES_PER_PROMPT = int(os.getenv("MAX_TOTAL_RETRIES_PER_PROMPT") or 30)
 BASE_BACKOFF_SECONDS = float(os.getenv("BASE_BACKOFF_SECONDS") or 1.0)
+# Backoff before attempt n+1 is BACKOFFS[n-1]; precomputed so the retry loop does no pow().
+BACKOFFS = tuple(BASE_BACKOFF_SECONDS * 1.5 ** i for i in range(MAX_TOTAL_RETRIES_PER_PROMPT))
+
+# Adaptive token bucket per key (requests/second). A key is unlimited until its first rate limit,
+# which clamps it to KEY_RATE_INITIAL; further limits divide the rate, successes grow it, and a key
+# whose rate climbs back to KEY_RATE_MAX is unlimited again.
+KEY_BUCKET_CAPACITY = float(os.getenv("KEY_BUCKET_CAPACITY") or 5)
+KEY_RATE_INITIAL = float(os.getenv("KEY_RATE_INITIAL") or 1.0)
+KEY_RATE_MIN = float(os.getenv("KEY_RATE_MIN") or 0.05)
+KEY_RATE_MAX = float(os.getenv("KEY_RATE_MAX") or 10.0)
+KEY_RATE_INCREASE_FACTOR = float(os.getenv("KEY_RATE_INCREASE_FACTOR") or 1.1)
+KEY_RATE_INCREASE_STEP = float(os.getenv("KEY_RATE_INCREASE_STEP") or 0.05)
+KEY_RATE_DECREASE_FACTOR = float(os.getenv("KEY_RATE_DECREASE_FACTOR") or 2.0)
+
+# /generate starts with one key and adds another (up to KEY_PROBE_CONCURRENCY in flight) when a
+# probe fails or none has answered within KEY_PROBE_HEDGE_SECONDS; the first 2xx wins.
+KEY_PROBE_CONCURRENCY = int(os.getenv("KEY_PROBE_CONCURRENCY") or 3)
+KEY_PROBE_HEDGE_SECONDS = float(os.getenv("KEY_PROBE_HEDGE_SECONDS") or 3.0)
+
+# Cooldown applied to a rate-limited key when Gemini sends no usable Retry-After header.
+KEY_COOLDOWN_DEFAULT_SECONDS = float(os.getenv("KEY_COOLDOWN_DEFAULT_SECONDS") or 30)
+
+# Connection pool for the shared Gemini client; retries reuse one keep-alive/HTTP2 session.
+HTTP_MAX_CONNECTIONS = int(os.getenv("HTTP_MAX_CONNECTIONS") or 100)
+HTTP_MAX_KEEPALIVE_CONNECTIONS = int(os.getenv("HTTP_MAX_KEEPALIVE_CONNECTIONS") or 40)
+HTTP_KEEPALIVE_EXPIRY_SECONDS = float(os.getenv("HTTP_KEEPALIVE_EXPIRY_SECONDS") or 30)
 
 
 logging.basicConfig(level=logging.INFO)
@@ -42,52 +76,142 @@ logger = logging.getLogger("gemini-rotator")
 
 
 SQLITE_DB = os.getenv("SQLITE_DB_PATH", "warnings_state.db")
+SQLITE_OPTIMIZE_INTERVAL_SECONDS = int(os.getenv("SQLITE_OPTIMIZE_INTERVAL_SECONDS") or 15 * 60)
+
 
+def utc_iso_now() -> str:
+    """
+    UTC timestamp like 2024-01-01T12:00:00.123456Z, without building a datetime object.
+    """
+    t = time.time()
+    return time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(t)) + f".{int((t % 1) * 1e6):06d}Z"
+
+def db_connect() -> sqlite3.Connection:
+    """
+    Opens the notifications DB in autocommit mode with WAL/NORMAL tuning.
+    The connection is shared across threads (see get_db), so all access goes through DB_LOCK.
+    """
+    conn = sqlite3.connect(SQLITE_DB, check_same_thread=False, isolation_level=None)
+    conn.execute("PRAGMA journal_mode=WAL;")
+    conn.execute("PRAGMA synchronous=NORMAL;")
+    conn.execute("PRAGMA busy_timeout=30000;")
+    conn.execute("PRAGMA temp_store=MEMORY;")
+    return conn
+
+# One long-lived connection per process instead of connect/close per operation.
+DB_CONN: Optional[sqlite3.Connection] = None
+DB_LOCK = threading.Lock()
+
+def get_db() -> sqlite3.Connection:
+    global DB_CONN
+    if DB_CONN is None:
+        DB_CONN = db_connect()
+    return DB_CONN
+
+def close_db():
+    global DB_CONN
+    with DB_LOCK:
+        if DB_CONN is not None:
+            DB_CONN.close()
+            DB_CONN = None
+
+# In-process mirror of key_notifications, only used to skip keys early. It is loaded once per
+# worker and updated by /generate when it claims a key; the INSERT in mark_keys_notified is
+# what decides whether an alert is sent.
+NOTIFIED_KEYS: set = set()
 
 def init_db():
-    conn = sqlite3.connect(SQLITE_DB)
-    c = conn.cursor()
-    c.execute(
-        """
-        CREATE TABLE IF NOT EXISTS key_notifications (
-            key_index INTEGER PRIMARY KEY,
-            notified_at TEXT
+    with DB_LOCK:
+        get_db().execute(
+            """
+            CREATE TABLE IF NOT EXISTS key_notifications (
+                key_index INTEGER PRIMARY KEY,
+                notified_at TEXT
+            )
+            """
         )
-        """
-    )
-    conn.commit()
-    conn.close()
 
 def get_notified_keys() -> set:
-    conn = sqlite3.connect(SQLITE_DB)
-    c = conn.cursor()
-    c.execute("SELECT key_index FROM key_notifications")
-    rows = c.fetchall()
-    conn.close()
+    with DB_LOCK:
+        rows = get_db().execute("SELECT key_index FROM key_notifications").fetchall()
     return {r[0] for r in rows}
 
-def mark_key_notified(key_index: int):
-    conn = sqlite3.connect(SQLITE_DB)
-    c = conn.cursor()
-    now = datetime.utcnow().isoformat() + "Z"
-    c.execute(
-        "INSERT OR REPLACE INTO key_notifications (key_index, notified_at) VALUES (?, ?)",
-        (key_index, now),
-    )
-    conn.commit()
-    conn.close()
+def mark_keys_notified(key_indices: List[int]) -> List[int]:
+    """
+    Records notifications for several keys in one transaction and returns the keys that were
+    newly inserted. Keys already recorded (e.g. by another worker) are left untouched, so the
+    table decides which process sends each alert.
+    """
+    now = utc_iso_now()
+    inserted: List[int] = []
+    with DB_LOCK:
+        conn = get_db()
+        conn.execute("BEGIN")
+        try:
+            for key_index in key_indices:
+                cur = conn.execute(
+                    "INSERT INTO key_notifications (key_index, notified_at) VALUES (?, ?) "
+                    "ON CONFLICT(key_index) DO NOTHING",
+                    (key_index, now),
+                )
+                if cur.rowcount == 1:
+                    inserted.append(key_index)
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+    return inserted
 
+async def mark_keys_notified_async(key_indices: List[int]) -> List[int]:
+    return await asyncio.to_thread(mark_keys_notified, key_indices)
 
-init_db()
+def optimize_db():
+    with DB_LOCK:
+        get_db().execute("PRAGMA optimize;")
+
+async def optimize_db_periodically():
+    while True:
+        await asyncio.sleep(SQLITE_OPTIMIZE_INTERVAL_SECONDS)
+        try:
+            await asyncio.to_thread(optimize_db)
+        except Exception as e:
+            logger.warning(f"PRAGMA optimize failed: {e}")
+
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Once per worker process at startup (not import), so DB errors surface as a failed startup.
+    init_db()
+    NOTIFIED_KEYS.update(get_notified_keys())
+    # One pooled client for the whole process so key rotation reuses connections.
+    limits = httpx.Limits(
+        max_connections=HTTP_MAX_CONNECTIONS,
+        max_keepalive_connections=HTTP_MAX_KEEPALIVE_CONNECTIONS,
+        keepalive_expiry=HTTP_KEEPALIVE_EXPIRY_SECONDS,
+    )
+    # Pool size and HTTP/2 live on the transport; httpx ignores them on the client once transport= is set.
+    # retries=0: rotation in /generate decides what to retry, not the transport.
+    transport = httpx.AsyncHTTPTransport(retries=0, http2=True, limits=limits)
+    app.state.http_client = httpx.AsyncClient(timeout=REQUEST_TIMEOUT_SECONDS, transport=transport)
+    optimize_task = asyncio.create_task(optimize_db_periodically())
+    try:
+        yield
+    finally:
+        optimize_task.cancel()
+        await app.state.http_client.aclose()
+        close_db()
 
 
-app = FastAPI(title="Gemini Key-Rotating Prompt Server (FastAPI)")
+app = FastAPI(title="Gemini Key-Rotating Prompt Server (FastAPI)", lifespan=lifespan)
 
 class GenerateRequest(BaseModel):
     prompt: str
     email_to: Optional[str] = None
     
     metadata: Optional[dict] = None
+    # Opt-in, so n8n workflows that call /generate themselves don't trigger their own webhook.
+    forward_to_n8n: bool = False
 
 class GeminiResponse(BaseModel):
     success: bool
@@ -119,17 +243,124 @@ def send_warning_email(subject: str, body: str, to_email: str):
         return False
 
 
-async def call_gemini_with_key(key: str, prompt: str, metadata: Optional[dict] = None) -> httpx.Response:
+# Strong references to fire-and-forget tasks so they aren't garbage-collected mid-flight.
+BACKGROUND_TASKS: set = set()
+
+def run_in_background(func, *args):
     """
-    Sends a request to Gemini. Adjust payload to Gemini's real REST API.
-    Returns httpx.Response
+    Runs a blocking function in a worker thread without awaiting it.
+    Unlike FastAPI BackgroundTasks, this also runs when the request ends in an HTTPException.
     """
-    headers = {
-        "Authorization": f"Bearer {key}",
-        "Content-Type": "application/json",
-    }
+    task = asyncio.create_task(asyncio.to_thread(func, *args))
+    BACKGROUND_TASKS.add(task)
+    task.add_done_callback(BACKGROUND_TASKS.discard)
+    return task
+
+
+@dataclass
+class KeyState:
+    tokens: float = KEY_BUCKET_CAPACITY
+    rate: float = KEY_RATE_INITIAL
+    capacity: float = KEY_BUCKET_CAPACITY
+    limited: bool = False
+    updated_at: float = field(default_factory=time.monotonic)
+
+    def refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def try_acquire(self) -> bool:
+        if not self.limited:
+            return True
+        self.refill(time.monotonic())
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
 
+    def seconds_until_token(self) -> float:
+        if not self.limited:
+            return 0.0
+        self.refill(time.monotonic())
+        return max(0.0, (1 - self.tokens) / self.rate)
 
+    def refund(self):
+        """
+        Returns a token taken for a probe whose result was never used.
+        """
+        if self.limited:
+            self.tokens = min(self.capacity, self.tokens + 1)
+
+    def increase_rate(self):
+        if not self.limited:
+            return
+        self.rate = min(self.rate * KEY_RATE_INCREASE_FACTOR + KEY_RATE_INCREASE_STEP, KEY_RATE_MAX)
+        if self.rate >= KEY_RATE_MAX:
+            self.limited = False
+
+    def decrease_rate(self):
+        self.refill(time.monotonic())
+        self.tokens = 0.0
+        if self.limited:
+            self.rate = max(self.rate / KEY_RATE_DECREASE_FACTOR, KEY_RATE_MIN)
+        else:
+            self.limited = True
+            self.rate = KEY_RATE_INITIAL
+
+
+# Per-process bucket state, keyed by 1-based key index.
+KEY_STATES: Dict[int, KeyState] = {}
+
+def get_key_state(idx: int) -> KeyState:
+    state = KEY_STATES.get(idx)
+    if state is None:
+        state = KEY_STATES[idx] = KeyState()
+    return state
+
+# Keys known to be rate-limited: key index -> time.monotonic() when the key may be tried again.
+KEY_COOLDOWN: Dict[int, float] = {}
+
+def parse_retry_after(resp: httpx.Response) -> float:
+    try:
+        return max(0.0, float(resp.headers.get("retry-after", KEY_COOLDOWN_DEFAULT_SECONDS)))
+    except ValueError:
+        # HTTP-date form; not worth parsing for a cooldown hint.
+        return KEY_COOLDOWN_DEFAULT_SECONDS
+
+def start_key_cooldown(idx: int, seconds: float):
+    KEY_COOLDOWN[idx] = time.monotonic() + seconds
+
+def key_cooldown_remaining(idx: int) -> float:
+    until = KEY_COOLDOWN.get(idx)
+    if until is None:
+        return 0.0
+    remaining = until - time.monotonic()
+    if remaining <= 0:
+        KEY_COOLDOWN.pop(idx, None)
+        return 0.0
+    return remaining
+
+def seconds_until_key_ready(idx: int) -> float:
+    return max(key_cooldown_remaining(idx), get_key_state(idx).seconds_until_token())
+
+def acquire_ready_key(exclude: set) -> Optional[int]:
+    """
+    Returns the first key index (in rotation order) not in `exclude` that is not cooling down
+    and has a token, consuming it.
+    """
+    for idx in range(1, len(GEMINI_KEYS) + 1):
+        if idx in exclude or key_cooldown_remaining(idx) > 0:
+            continue
+        if get_key_state(idx).try_acquire():
+            return idx
+    return None
+
+
+def build_gemini_body(prompt: str, metadata: Optional[dict] = None) -> bytes:
+    """
+    Serialises the Gemini request body once per prompt; only the key changes between attempts.
+    Adjust payload to Gemini's real REST API.
+    """
     payload = {
         "model": GEMINI_MODEL,
         "prompt": prompt,
@@ -138,16 +369,173 @@ async def call_gemini_with_key(key: str, prompt: str, metadata: Optional[dict] =
     }
     if metadata:
         payload["metadata"] = metadata
+    try:
+        return orjson.dumps(payload)
+    except TypeError:
+        # orjson rejects valid inputs such as integers beyond 64 bits; the stdlib encoder doesn't.
+        return json.dumps(payload).encode()
+
+async def call_gemini_with_key(client: httpx.AsyncClient, key: str, body: bytes) -> httpx.Response:
+    """
+    Sends a pre-serialised request body (see build_gemini_body) to Gemini using the shared client.
+    Returns a streaming httpx.Response whose body has not been read yet;
+    the caller must read it (aread/aiter_bytes) or aclose() it.
+    """
+    headers = {
+        "Authorization": f"Bearer {key}",
+        "Content-Type": "application/json",
+    }
+
+    request = client.build_request("POST", GEMINI_API_ENDPOINT, headers=headers, content=body)
+    return await client.send(request, stream=True)
+
+# One pass over the text for "ratelimit", "rate limit", "rateLimitExceeded", "quota", ...
+RATE_LIMIT_RE = re.compile(r"rate[\s_-]?limit(?:exceeded)?|quota", re.IGNORECASE)
+RATE_LIMIT_STATUSES = {"RESOURCE_EXHAUSTED"}
+
+def contains_rate_limit_keyword(text: str) -> bool:
+    return RATE_LIMIT_RE.search(text) is not None
+
+def is_rate_limit_payload(payload) -> bool:
+    """
+    Detects a rate-limit error from the fields of a JSON error object instead of
+    serialising the whole body. Callers scan the raw text for anything that isn't a dict.
+    """
+    message = payload.get("message")
+    if isinstance(message, str) and contains_rate_limit_keyword(message):
+        return True
+
+    error = payload.get("error")
+    if isinstance(error, str):
+        return contains_rate_limit_keyword(error)
+    if not isinstance(error, dict):
+        return False
+    status = error.get("status")
+    if status in RATE_LIMIT_STATUSES or error.get("code") == 429:
+        return True
+    if isinstance(status, str) and contains_rate_limit_keyword(status):
+        return True
+    message = error.get("message")
+    if isinstance(message, str) and contains_rate_limit_keyword(message):
+        return True
+    # Google-style envelopes carry e.g. {"reason": "rateLimitExceeded"} under errors/details.
+    for field_name in ("errors", "details"):
+        items = error.get(field_name)
+        if not isinstance(items, list):
+            continue
+        for item in items:
+            reason = item.get("reason") if isinstance(item, dict) else None
+            if isinstance(reason, str) and contains_rate_limit_keyword(reason):
+                return True
+    return False
+
+async def forward_to_n8n(client: httpx.AsyncClient, metadata: Optional[dict], raw_response: Optional[dict]):
+    """
+    Posts the generated response to the n8n webhook. Runs after /generate has responded.
+    """
+    n8n_payload = {**(metadata or {}), "aiResponse": raw_response or ""}
+    try:
+        resp = await client.post(N8N_WEBHOOK_URL, json=n8n_payload, timeout=30)
+        if resp.status_code == 200:
+            logger.info("Sent AI response to n8n successfully.")
+        else:
+            logger.warning(f"n8n webhook returned status {resp.status_code}")
+    except (httpx.HTTPError, httpx.InvalidURL) as e:
+        logger.error(f"Failed to send data to n8n: {e}")
+
+async def probe_key(client: httpx.AsyncClient, idx: int, body: bytes):
+    """
+    Runs one attempt with key `idx` as a task for asyncio.wait.
+    Returns (idx, response, None) or (idx, None, network_error). A 2xx response is left
+    open for streaming; any other response is read fully (error bodies are small) and closed.
+    """
+    try:
+        resp = await call_gemini_with_key(client, GEMINI_KEYS[idx - 1], body)
+    except httpx.RequestError as e:
+        return idx, None, e
+    if 200 <= resp.status_code < 300:
+        return idx, resp, None
+    try:
+        await resp.aread()
+    except httpx.RequestError as e:
+        return idx, None, e
+    finally:
+        await resp.aclose()
+    return idx, resp, None
+
+async def close_unused_responses(in_flight: Dict[asyncio.Task, int], keep: Optional[httpx.Response]):
+    """
+    Cancels probes whose results were never used and closes any streamed response other than `keep`.
+    Their keys' buckets are settled: a cancelled or failed probe gets its token back, and a 2xx
+    that merely lost the race still counts as a success for its key.
+    """
+    tasks = list(in_flight)
+    for task in tasks:
+        task.cancel()
+    results = await asyncio.gather(*tasks, return_exceptions=True)
+    for task, result in zip(tasks, results):
+        key_state = get_key_state(in_flight[task])
+        resp = result[1] if isinstance(result, tuple) else None
+        if resp is None:
+            key_state.refund()
+            continue
+        if 200 <= resp.status_code < 300:
+            key_state.increase_rate()
+        if resp is not keep and not resp.is_closed:
+            await resp.aclose()
+
+async def read_stream_head(chunks) -> bytes:
+    """
+    Reads body chunks until the first non-whitespace byte (or the end of the body), so an
+    empty or dead 2xx stream is caught before anything is sent to the client.
+    """
+    head = b""
+    while not head.strip():
+        try:
+            head += await chunks.__anext__()
+        except StopAsyncIteration:
+            break
+    return head
+
+async def stream_gemini_response(resp: httpx.Response, idx: int, head: bytes, chunks, captured: Optional[bytearray] = None):
+    """
+    Streams the upstream body inside the GeminiResponse JSON envelope as chunks arrive.
+    `head` is the already-read start of the body and `chunks` the rest of resp.aiter_bytes().
+    If `captured` is given, the raw body is also collected there (used for n8n forwarding).
+    A failure mid-stream is re-raised so the connection is aborted instead of closing the envelope.
+    """
+    if captured is not None:
+        captured.extend(head)
+    yield b'{"success":true,"key_used_index":%d,"raw_response":' % idx + head
+    try:
+        async for chunk in chunks:
+            if captured is not None:
+                captured.extend(chunk)
+            yield chunk
+    except httpx.RequestError as e:
+        logger.error(f"Stream from key index {idx} broke off: {e}")
+        raise
+    finally:
+        await resp.aclose()
+    yield b',"error":null}'
+
+async def forward_captured_to_n8n(client: httpx.AsyncClient, metadata: Optional[dict], captured: bytearray):
+    try:
+        raw_response = orjson.loads(bytes(captured))
+    except orjson.JSONDecodeError:
+        raw_response = {"raw_text": captured.decode(errors="replace")}
+    await forward_to_n8n(client, metadata, raw_response)
 
-    async with httpx.AsyncClient(timeout=REQUEST_TIMEOUT_SECONDS) as client:
-        resp = await client.post(GEMINI_API_ENDPOINT, headers=headers, json=payload)
-        return resp
 @app.post("/generate", response_model=GeminiResponse)
-async def generate(req: GenerateRequest):
+async def generate(req: GenerateRequest, request: Request, background_tasks: BackgroundTasks):
     """
-    Try each key in order. If a key returns a rate-limit error, rotate to the next key.
+    Try ready keys in rotation order and stream back the first success. The next key is started
+    when a probe fails, or hedged in parallel when none has answered within KEY_PROBE_HEDGE_SECONDS.
+    Keys still cooling down from a recent rate limit, or whose token bucket is empty, are skipped;
+    a rate-limited key is throttled. Only wait when no untried key is ready.
     If keys #5, #8, #10 are used for the first time (i.e., we attempted them and received rate-limit),
     send an email notification (exact text per assignment).
+    With forward_to_n8n set, the successful response is posted to N8N_WEBHOOK_URL after returning.
     """
 
     if not GEMINI_KEYS:
@@ -156,86 +544,209 @@ async def generate(req: GenerateRequest):
     email_to = req.email_to or DEFAULT_WARNING_TO
     prompt = req.prompt
     metadata = req.metadata
+    client: httpx.AsyncClient = request.app.state.http_client
+    gemini_body = build_gemini_body(prompt, metadata)
 
     total_attempts = 0
     last_error = None
-    notified_keys = get_notified_keys()
-
-    for idx, key in enumerate(GEMINI_KEYS, start=1):
-
-        if total_attempts >= MAX_TOTAL_RETRIES_PER_PROMPT:
-            break
-
-        try:
-            total_attempts += 1
-            logger.info(f"Attempting Gemini request with key index {idx}/{len(GEMINI_KEYS)} (attempt #{total_attempts})")
-            resp = await call_gemini_with_key(key, prompt, metadata)
-        except httpx.RequestError as e:
-            logger.exception(f"Network error using key index {idx}: {e}")
-            last_error = str(e)
-
-            await asyncio.sleep(BASE_BACKOFF_SECONDS * (1.5 ** (total_attempts - 1)))
-            continue
-
-
-        status = resp.status_code
-        text = resp.text
-        try:
-            payload = resp.json()
-        except Exception:
-            payload = {"raw_text": text}
-
-        if 200 <= status < 300:
-            logger.info(f"Successful response with key index {idx}")
-            return GeminiResponse(success=True, key_used_index=idx, raw_response=payload)
+    notified_keys = NOTIFIED_KEYS
 
+    tried_keys: set = set()
+    stop = False
+    # Sleeps are capped so cumulative waiting never outlives what the caller will wait for.
+    deadline = time.monotonic() + REQUEST_TIMEOUT_SECONDS * 2
 
-        is_rate_limit = False
+    # Probes whose result hasn't been handled yet, mapped to their key index.
+    in_flight: Dict[asyncio.Task, int] = {}
+    winner: Optional[httpx.Response] = None
+    pending_alerts: List[tuple] = []
+    network_error = False
+    # Probes to start: one up front, plus one per failed probe and per elapsed hedge delay.
+    launches_owed = 1
 
-        if status == 429:
-            is_rate_limit = True
-        else:
-
-            body_str = json.dumps(payload) if isinstance(payload, dict) else str(payload)
-            lower = body_str.lower()
-            if "ratelimit" in lower or "rate limit" in lower or "ratelimitexceeded" in lower or "quota" in lower:
-                is_rate_limit = True
-
-        if is_rate_limit:
-            logger.warning(f"Rate limit detected for key index {idx}.")
-            last_error = f"Rate limit for key index {idx}"
-
-            if idx in WATCH_KEYS_INDICES and idx not in notified_keys:
-                subject = f"API Key #{idx} has reached its limit. Please prepare the next batch of 10 keys."
-                body = (
-                    f"Automated alert: API Key #{idx} (1-based index) triggered a rate limit response at {datetime.utcnow().isoformat()}Z.\n\n"
-                    "Please prepare the next batch of 10 keys and rotate them into your environment variables.\n\n"
-                    "This is an automated notification from the Gemini key-rotating server."
+    try:
+        while not stop:
+            while (
+                launches_owed > 0
+                and len(in_flight) < KEY_PROBE_CONCURRENCY
+                and total_attempts < MAX_TOTAL_RETRIES_PER_PROMPT
+                and len(tried_keys) < len(GEMINI_KEYS)
+            ):
+                idx = acquire_ready_key(tried_keys)
+                if idx is None:
+                    break
+                tried_keys.add(idx)
+                total_attempts += 1
+                launches_owed -= 1
+                logger.info(f"Attempting Gemini request with key index {idx}/{len(GEMINI_KEYS)} (attempt #{total_attempts})")
+                in_flight[asyncio.create_task(probe_key(client, idx, gemini_body))] = idx
+
+            can_launch = total_attempts < MAX_TOTAL_RETRIES_PER_PROMPT and len(tried_keys) < len(GEMINI_KEYS)
+
+            if not in_flight:
+                if not can_launch:
+                    break
+                wait = min(
+                    seconds_until_key_ready(i)
+                    for i in range(1, len(GEMINI_KEYS) + 1)
+                    if i not in tried_keys
                 )
-                sent = send_warning_email(subject, body, email_to)
-                if sent:
-                    mark_key_notified(idx)
+                if wait >= deadline - time.monotonic():
+                    logger.warning(f"No key is ready before the request deadline (next in {wait:.2f}s).")
+                    break
+                logger.info(f"All remaining keys are throttled; waiting {wait:.2f}s for one to be ready.")
+                await asyncio.sleep(wait)
+                continue
+
+            # Hedge: if the probes in flight are slow and a slot is free, add another key in parallel.
+            can_hedge = can_launch and len(in_flight) < KEY_PROBE_CONCURRENCY
+            done, _ = await asyncio.wait(
+                in_flight,
+                timeout=KEY_PROBE_HEDGE_SECONDS if can_hedge else None,
+                return_when=asyncio.FIRST_COMPLETED,
+            )
+            if not done:
+                logger.info(f"No answer within {KEY_PROBE_HEDGE_SECONDS}s; trying another key in parallel.")
+                launches_owed += 1
+                continue
+
+            for task in done:
+                in_flight.pop(task)
+                idx, resp, error = task.result()
+                # Any result that isn't returned frees a slot for the next key.
+                launches_owed += 1
+                key_state = get_key_state(idx)
+
+                if error is not None:
+                    logger.error(f"Network error using key index {idx}: {error}")
+                    last_error = str(error)
+                    network_error = True
+                    continue
+
+
+                status = resp.status_code
+
+                if 200 <= status < 300:
+                    # Read the start of the body before committing to a 200, so a dead or empty
+                    # stream still rotates to the next key like any other network error.
+                    chunks = resp.aiter_bytes()
+                    try:
+                        head = await read_stream_head(chunks)
+                        streamable = "json" in resp.headers.get("content-type", "") and head.lstrip().startswith(b"{")
+                        body_bytes = None if streamable else head + b"".join([c async for c in chunks])
+                    except httpx.RequestError as e:
+                        await resp.aclose()
+                        logger.error(f"Network error reading response from key index {idx}: {e}")
+                        last_error = str(e)
+                        network_error = True
+                        continue
+
+                    if not head.strip():
+                        await resp.aclose()
+                        logger.error(f"Empty response body from key index {idx}.")
+                        last_error = f"Empty response body from key index {idx}"
+                        network_error = True
+                        continue
+
+                    logger.info(f"Successful response with key index {idx}")
+                    key_state.increase_rate()
+                    forward = req.forward_to_n8n and N8N_WEBHOOK_URL
+
+                    if streamable:
+                        winner = resp
+                        captured = bytearray() if forward else None
+                        if forward:
+                            # FastAPI attaches background_tasks to the returned response; they run after the stream ends.
+                            background_tasks.add_task(forward_captured_to_n8n, client, metadata, captured)
+                        return StreamingResponse(
+                            stream_gemini_response(resp, idx, head, chunks, captured),
+                            media_type="application/json",
+                        )
+
+                    # Non-JSON, or JSON that isn't an object, can't be embedded as raw_response;
+                    # return it as text in the usual model.
+                    await resp.aclose()
+                    payload = {"raw_text": body_bytes.decode(errors="replace")}
+                    if forward:
+                        background_tasks.add_task(forward_to_n8n, client, metadata, payload)
+                    return GeminiResponse(success=True, key_used_index=idx, raw_response=payload)
+
+                # Only ambiguous statuses (e.g. 400) need the body parsed to spot a rate limit.
+                if status == 429:
+                    is_rate_limit = True
+                elif status in (401, 403) or 500 <= status < 600:
+                    is_rate_limit = False
                 else:
-                    logger.warning(f"Failed to send notification for key {idx}. Continuing rotation.")
-
-            await asyncio.sleep(BASE_BACKOFF_SECONDS * (1.5 ** (total_attempts - 1)))
-            continue
-
-
-        logger.error(f"Non-success status {status} for key index {idx}. Body: {payload}")
-        last_error = f"Status {status}: {payload}"
-
-        if status in (401, 403):
-            logger.info(f"Auth error for key index {idx}. Trying next key.")
-            await asyncio.sleep(0.2)
-            continue
-
-        if 500 <= status < 600:
-            await asyncio.sleep(BASE_BACKOFF_SECONDS * (1.5 ** (total_attempts - 1)))
-            continue
-
-
-        break
+                    try:
+                        payload = orjson.loads(resp.content)
+                    except Exception:
+                        payload = None
+                    if isinstance(payload, dict):
+                        is_rate_limit = is_rate_limit_payload(payload)
+                    else:
+                        # Non-JSON, or JSON that isn't an object (list, bare string, ...).
+                        is_rate_limit = contains_rate_limit_keyword(resp.text)
+
+                if is_rate_limit:
+                    logger.warning(f"Rate limit detected for key index {idx}.")
+                    last_error = f"Rate limit for key index {idx}"
+                    key_state.decrease_rate()
+                    start_key_cooldown(idx, parse_retry_after(resp))
+
+                    if idx in WATCH_KEYS_INDICES and idx not in notified_keys:
+                        subject = f"API Key #{idx} has reached its limit. Please prepare the next batch of 10 keys."
+                        body = (
+                            f"Automated alert: API Key #{idx} (1-based index) triggered a rate limit response at {utc_iso_now()}.\n\n"
+                            "Please prepare the next batch of 10 keys and rotate them into your environment variables.\n\n"
+                            "This is an automated notification from the Gemini key-rotating server."
+                        )
+                        # Claim the key now so concurrent requests don't alert twice; persisted and sent before returning.
+                        notified_keys.add(idx)
+                        pending_alerts.append((idx, subject, body))
+
+                    continue
+
+
+                body_excerpt = resp.text[:512]
+                logger.error(f"Non-success status {status} for key index {idx}. Body: {body_excerpt}")
+                last_error = f"Status {status}: {body_excerpt}"
+
+                if status in (401, 403):
+                    logger.info(f"Auth error for key index {idx}. Trying next key.")
+                    continue
+
+                if 500 <= status < 600:
+                    # Server errors aren't the key's fault; skip it for this request but keep its bucket.
+                    continue
+
+
+                stop = True
+                break
+
+            if network_error and not stop and not in_flight and len(tried_keys) < len(GEMINI_KEYS):
+                network_error = False
+                wait = min(BACKOFFS[total_attempts - 1], deadline - time.monotonic())
+                if wait <= 0:
+                    logger.warning("Request deadline reached; not backing off further.")
+                    break
+                await asyncio.sleep(wait)
+    finally:
+        # First success (or a fatal status) wins; cancel the rest and settle their keys' buckets.
+        await close_unused_responses(in_flight, winner)
+        if pending_alerts:
+            # One write for every watched key that hit its limit in this request, before any email goes out.
+            # Only keys this process actually inserted are emailed; another worker may have claimed the rest.
+            # A failed write must not replace the request's result (e.g. a StreamingResponse being returned).
+            alert_keys = [alert[0] for alert in pending_alerts]
+            try:
+                inserted = await mark_keys_notified_async(alert_keys)
+            except Exception as e:
+                # Can't tell whether another worker already alerted; prefer a duplicate over a lost alert.
+                logger.exception(f"Failed to record key notifications; sending alerts anyway: {e}")
+                inserted = alert_keys
+            for alert_idx, subject, body in pending_alerts:
+                if alert_idx in inserted:
+                    run_in_background(send_warning_email, subject, body, email_to)
 
 
     logger.error("All keys exhausted or retries exceeded.")